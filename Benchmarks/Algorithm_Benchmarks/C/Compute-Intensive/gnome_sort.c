@@ -17,7 +17,10 @@ void gnome_sort(int *array, int size){
    }
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -52,7 +52,10 @@ void build_maxheap(int *a, int n)
     }
 }
 
-  int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+  int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
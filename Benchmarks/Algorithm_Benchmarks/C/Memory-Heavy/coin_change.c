@@ -34,7 +34,10 @@ int minCoins(int coins[], int m, int V)
 } 
   
 // Driver program to test above function
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -46,7 +46,10 @@ int binarysearch2(const int *arr, int l, int r, int x)
 
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
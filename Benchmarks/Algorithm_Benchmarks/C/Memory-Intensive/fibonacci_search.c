@@ -62,7 +62,10 @@ int fibMonaccianSearch(int arr[], int x, int n)
     return -1;
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -21,7 +21,10 @@ static int kadane(int Array[], int n) {
   return max_sum;
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -42,7 +42,10 @@ void bubbleSort(int *arr, int size)
     }
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -98,7 +98,10 @@ void merge_sort(int *a, int n, int l, int r, int *b)
 }
 /** @} */
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -30,7 +30,10 @@ int cutRod(int price[], int n)
     return val[n];
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
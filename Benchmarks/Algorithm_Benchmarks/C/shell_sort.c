@@ -21,7 +21,10 @@ void shellSort(int array[], int len)
                 swap(&array[j], &array[j + gap]);
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
@@ -30,7 +30,10 @@ void stoogesort(int arr[], int l, int h)
     }
 }
 
-int n = 97;
+#ifndef N_VALUE
+#define N_VALUE 97
+#endif
+int n = N_VALUE;
 
 /** Driver Code */
 int main(int argc, const char *argv[]) {
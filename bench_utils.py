@@ -0,0 +1,258 @@
+import os
+import random
+import threading
+import multiprocessing
+import subprocess
+import glob
+import atexit
+import contextlib
+import functools
+import hashlib
+import shutil
+import argparse
+import logging as log
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def parse_cpu_list(text):
+    # Kernel CPU list syntax, e.g. "2-3,5"
+    cpus = set()
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def default_bench_cpu():
+    # Prefer a core reserved with isolcpus=; those are never in our own affinity mask,
+    # so without one fall back to the highest core we are allowed to run on
+    try:
+        with open('/sys/devices/system/cpu/isolated') as f:
+            isolated = parse_cpu_list(f.read())
+    except OSError:
+        isolated = set()
+    return max(isolated or os.sched_getaffinity(0))
+
+# Core the timed runs are pinned to; override with BENCH_CPU=
+BENCH_CPU = int(os.environ.get('BENCH_CPU', default_bench_cpu()))
+# Captured at import, before avoid_bench_cpu narrows a pool worker's mask
+ALL_CPUS = frozenset(os.sched_getaffinity(0))
+CACHE_DIR = '.cache/compile'
+# These benchmarks are multi-threaded (rayon/pthreads); pinning them to BENCH_CPU
+# would turn the comparison into a single-core one, so they run on every core
+# while compilation is paused
+PARALLEL_BENCHMARK_DIRS = ('Benchmarks/Performance_Benchmarks',)
+
+def get_benchmark_dirs():
+    dirs = ['Benchmarks/Algorithm_Benchmarks', 'Benchmarks/Performance_Benchmarks']
+    random.shuffle(dirs)
+    return dirs
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def setup_logging():
+    log.basicConfig(
+        level=log.INFO,
+        format='\033[36m%(asctime)s\033[0m - \033[1;33m%(levelname)s\033[0m - \033[32m%(message)s\033[0m',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+def restore_cpu(original):
+    for path, value in original.items():
+        try:
+            with open(path, 'w') as f:
+                f.write(f"{value}\n")
+        except OSError:
+            log.warning(f"Could not restore {path} to {value}")
+
+def setup_cpu():
+    # Best effort: fix the frequency governor and turn off turbo boost so that
+    # timings don't depend on which run happened to hit a higher P-state.
+    # The previous values are put back when the script exits.
+    settings = [(path, 'performance') for path in glob.glob('/sys/devices/system/cpu/cpu*/cpufreq/scaling_governor')]
+    settings += [('/sys/devices/system/cpu/cpufreq/boost', '0'), ('/sys/devices/system/cpu/intel_pstate/no_turbo', '1')]
+    original = {}
+    failed = []
+    for path, value in settings:
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path) as f:
+                current = f.read().strip()
+            with open(path, 'w') as f:
+                f.write(f"{value}\n")
+            original[path] = current
+        except OSError:
+            failed.append(path)
+    if failed:
+        log.warning(f"Could not configure CPU frequency settings (requires root): {', '.join(failed)}")
+    if original:
+        atexit.register(restore_cpu, original)
+
+def bench_cpus(d):
+    return ALL_CPUS if d in PARALLEL_BENCHMARK_DIRS else {BENCH_CPU}
+
+def bench_command(argv, cpus):
+    # Always set the mask explicitly: a benchmark started from a pool worker would
+    # otherwise inherit the worker's mask, which leaves out BENCH_CPU.
+    # Also raise priority when we are allowed to
+    prefix = ['taskset', '-c', ','.join(map(str, sorted(cpus)))]
+    if os.geteuid() == 0:
+        prefix += ['nice', '-n', '-10']
+    return prefix + argv
+
+def avoid_bench_cpu():
+    # Pool initializer: keeps compilers off BENCH_CPU while another benchmark is being timed there
+    others = os.sched_getaffinity(0) - {BENCH_CPU}
+    if others:
+        os.sched_setaffinity(0, others)
+
+class BuildLock:
+    # Builds hold it shared; timing a parallel benchmark holds it exclusively so no
+    # compiler competes for its cores. A waiting exclusive holder keeps new builds
+    # from starting, so a steady stream of builds can't starve it
+    def __init__(self, manager):
+        self._cond = manager.Condition()
+        self._holders = manager.Value('i', 0)  # number of builds, or -1 while held exclusively
+        self._waiting = manager.Value('i', 0)
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._cond:
+            while self._holders.value < 0 or self._waiting.value > 0:
+                self._cond.wait()
+            self._holders.value += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holders.value -= 1
+                if self._holders.value == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting.value += 1
+            while self._holders.value != 0:
+                self._cond.wait()
+            self._waiting.value -= 1
+            self._holders.value = -1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holders.value = 0
+                self._cond.notify_all()
+
+@contextlib.contextmanager
+def timing(d, run_lock, build_lock):
+    # Only one benchmark is timed at a time. Builds never run on BENCH_CPU, but a
+    # parallel benchmark uses every core, so builds are paused for it as well
+    with run_lock:
+        if d in PARALLEL_BENCHMARK_DIRS:
+            with build_lock.exclusive():
+                yield
+        else:
+            yield
+
+@functools.lru_cache(maxsize=None)
+def compiler_version(compiler):
+    return subprocess.run([compiler, '--version'], capture_output=True, text=True, check=True).stdout
+
+def cache_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+    return h.hexdigest()
+
+def fetch_cached(key, out):
+    cached = f"{CACHE_DIR}/{key}.elf"
+    if not os.path.exists(cached):
+        return False
+    shutil.copy(cached, out)
+    log.info(f"Using cached build {cached} for {out}")
+    return True
+
+def store_cached(key, out):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Copy under a PID-stamped name first so parallel workers never see a partial ELF
+    tmp = f"{CACHE_DIR}/{key}.{os.getpid()}.tmp"
+    shutil.copy(out, tmp)
+    os.rename(tmp, f"{CACHE_DIR}/{key}.elf")
+
+def load_evaluated(results_file, header):
+    if not os.path.exists(results_file):
+        return set()
+    with open(results_file, "r") as f:
+        existing = next(f, None)
+        # Appending rows with a different column layout would leave a corrupt CSV
+        if existing is not None and existing != header:
+            raise SystemExit(f"{results_file} has a different column layout than this script writes; "
+                             "move it away or pass another file with -o")
+        return {line.split(",", 1)[0] for line in f}
+
+def writer_loop(results_queue, results_file, header, write_results):
+    # The only place results_file is written, so rows from parallel workers never interleave
+    with open(results_file, "a") as f:
+        if f.tell() == 0:
+            f.write(header)
+        while (result := results_queue.get()) is not None:
+            write_results(f, *result)
+
+def run_benchmarks(make_task, benchmark, jobs, results_file, header, write_results):
+    # make_task(d, c_file, run_lock, build_lock, results_queue) returns the callable a pool worker
+    # runs for one benchmark; workers report results by putting write_results' arguments on results_queue
+    benchmark_dirs = get_benchmark_dirs()
+    done = load_evaluated(results_file, header)
+
+    total_benchmarks = 0
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=jobs, initializer=avoid_bench_cpu) as executor:
+        # Compilation runs in parallel, but only one benchmark is timed at a time
+        run_lock = manager.Lock()
+        build_lock = BuildLock(manager)
+        results_queue = manager.Queue()
+        writer = threading.Thread(target=writer_loop, args=(results_queue, results_file, header, write_results))
+        writer.start()
+        futures = {}
+        # Check if already evaluated in the results file before anything is submitted
+        if benchmark in done:
+            print(f"Skipping {benchmark} as it was already evaluated")
+        elif benchmark:
+            # Run specific benchmark
+            for d in benchmark_dirs:
+                c_file = f"{d}/C/{benchmark}.c"
+                if os.path.exists(c_file):
+                    futures[executor.submit(make_task(d, c_file, run_lock, build_lock, results_queue))] = c_file
+                    break
+            else:
+                log.error(f"Benchmark {benchmark} not found")
+        else:
+            # Run all benchmarks
+            for d in benchmark_dirs:
+                c_files = [entry.path for entry in os.scandir(f"{d}/C") if entry.name.endswith(".c") and entry.is_file()]
+                random.shuffle(c_files)
+
+                for c_file in c_files:
+                    base_name = os.path.splitext(os.path.basename(c_file))[0]
+                    if base_name in done:
+                        print(f"Skipping {base_name} as it was already evaluated")
+                        continue
+                    futures[executor.submit(make_task(d, c_file, run_lock, build_lock, results_queue))] = c_file
+
+        try:
+            for future in as_completed(futures):
+                # A failing benchmark is logged and skipped so the rest still get recorded
+                try:
+                    future.result()
+                except Exception:
+                    log.exception(f"Benchmark {futures[future]} failed")
+                    continue
+                total_benchmarks += 1
+        finally:
+            results_queue.put(None)
+            writer.join()
+    log.info(f"Total benchmarks: {total_benchmarks}")
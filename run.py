@@ -1,99 +1,172 @@
 import os
 import subprocess
 import time
-import random
+import statistics
 import glob
-import re
 import pathlib
 import logging as log
 import argparse
-
-def get_benchmark_dirs():
-  dirs = ['Benchmarks/Algorithm_Benchmarks', 'Benchmarks/Performance_Benchmarks']
-  random.shuffle(dirs)
-  return dirs
-
-def compile_c_source(c_source, c_out, opt_level):
+import shutil
+import json
+import multiprocessing
+import functools
+from bench_utils import setup_logging, setup_cpu, bench_command, bench_cpus, timing, compiler_version, cache_key, fetch_cached, store_cached, positive_int, run_benchmarks
+
+def compile_c(c_file, c_out, opt_level, input_size):
+  # The input size is passed as a define instead of patching the source
+  cflags = ['-w', f'-O{opt_level}', f'-DN_VALUE={input_size}', '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp']
+  key = cache_key(pathlib.Path(c_file).read_bytes(), cflags, compiler_version('gcc'))
+  if fetch_cached(key, c_out):
+    return True
   try:
-    subprocess.run(['gcc', '-w', f'-O{opt_level}', '-xc', '-', '-o', c_out, '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp'], input=c_source, check=True, text=True)
+    subprocess.run(['gcc', c_file, *cflags, '-o', c_out], check=True)
+    store_cached(key, c_out)
     return True
   except subprocess.CalledProcessError:
     log.error("C compilation failed")
     return False
 
+def cargo_binary(rust_dir):
+  metadata = json.loads(subprocess.run(['cargo', 'metadata', '--format-version', '1', '--no-deps'],
+                                       cwd=rust_dir, capture_output=True, text=True, check=True).stdout)
+  bin_name = next(target['name'] for package in metadata['packages'] for target in package['targets'] if 'bin' in target['kind'])
+  return os.path.join(metadata['target_directory'], 'release', bin_name)
+
+def cargo_up_to_date(rust_dir, rust_out, flags):
+  # The flags stamp catches opt-level changes, which source mtimes can't
+  stamp = f"{rust_out}.flags"
+  if not (os.path.exists(rust_out) and os.path.exists(stamp)):
+    return False
+  if pathlib.Path(stamp).read_text() != flags:
+    return False
+  sources = glob.glob(f"{rust_dir}/src/**/*.rs", recursive=True) + glob.glob(f"{rust_dir}/Cargo.*")
+  return max(os.path.getmtime(p) for p in sources) < os.path.getmtime(rust_out)
+
 def compile_rust(rust_file, rust_dir, rust_out, opt_level):
   flags = f"-A warnings -C opt-level={opt_level}"
-  os.environ["RUSTFLAGS"] = flags
   try:
     if os.path.exists(rust_file):
+      key = cache_key(pathlib.Path(rust_file).read_bytes(), flags, compiler_version('rustc'))
+      if fetch_cached(key, rust_out):
+        return True
       subprocess.run(['rustc', *flags.split(), rust_file, '-o', rust_out], check=True)
+      store_cached(key, rust_out)
     else:
+      if cargo_up_to_date(rust_dir, rust_out, flags):
+        log.info(f"{rust_out} is up to date, skipping cargo build")
+        return True
+      # Pass RUSTFLAGS only to cargo so the parent's environment stays untouched
       subprocess.run(['cargo', 'build', '--release'], check=True,
-                     cwd=rust_dir)
+                     cwd=rust_dir, env={**os.environ, "RUSTFLAGS": flags})
+      # Copy the built binary out so the timed run doesn't go through cargo
+      shutil.copy(cargo_binary(rust_dir), rust_out)
+      pathlib.Path(f"{rust_out}.flags").write_text(flags)
     return True
   except subprocess.CalledProcessError:
     log.error("Rust compilation failed")
     return False
 
-def run_c_benchmark(c_out, input_data_file):
+def spawn_benchmark(argv, input_data_file):
+  # posix_spawn + wait4 lets the kernel report the child's CPU usage directly;
+  # the benchmark's stdout is never inspected, so it goes straight to /dev/null
+  file_actions = [
+    (os.POSIX_SPAWN_OPEN, 0, str(input_data_file), os.O_RDONLY, 0),
+    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+  ]
+  start = time.perf_counter_ns()
+  pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=file_actions)
+  _, status, rusage = os.wait4(pid, 0)
+  wall_time = (time.perf_counter_ns() - start) / 1e9
+  returncode = os.waitstatus_to_exitcode(status)
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode, argv)
+  return wall_time, rusage.ru_utime + rusage.ru_stime
+
+def run_c_benchmark(c_out, input_data_file, cpus):
   try:
-    start_time = time.time()
-    c_output = subprocess.run([c_out], stdin=open(input_data_file), capture_output=True, text=True, check=True)
-    # c_time = float(re.search(r'(\d+\.?\d+)', c_output.stdout).group(1))
-    elapsed_time = time.time() - start_time
-    log.info(f"C output: {c_output.stdout}")
-    return elapsed_time
+    return spawn_benchmark(bench_command([c_out], cpus), input_data_file)
   except:
     log.error("C benchmark failed")
     return None
 
-def run_rust_benchmark(rust_file, rust_out, rust_dir, input_data_file):
+def run_rust_benchmark(rust_out, input_data_file, cpus):
   try:
-    start_time = time.time()
-    if os.path.exists(rust_file):
-      rust_output = subprocess.run([rust_out], stdin=open(input_data_file), capture_output=True, text=True, check=True)
-    else:
-      rust_output = subprocess.run(['cargo', 'run', '--release'],
-                     cwd=rust_dir,
-                     stdin=open(input_data_file),
-                     capture_output=True,
-                     text=True,
-                     check=True)
-    elapsed_time = time.time() - start_time
-    # Keep original time parsing logic as backup/verification
-    # parsed_time = float(re.search(r'(\d+\.?\d+)', rust_output.stdout).group(1))
-    log.info(f"Rust output: {rust_output.stdout}")
-    return elapsed_time
+    return spawn_benchmark(bench_command([rust_out], cpus), input_data_file)
   except:
     log.error("Rust benchmark failed")
     return None
 
-def write_results(results_file, base_name, c_time, rust_time):
+def drop_page_cache():
+  subprocess.run(['sync'])
+  try:
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+      f.write('3\n')
+  except OSError:
+    log.warning("Could not drop the page cache (requires root)")
+
+def _measure_once(queue, run, args):
+  # Runs in a freshly spawned interpreter, so logging has to be set up again
+  setup_logging()
+  queue.put(run(*args))
+
+def run_isolated(run, args):
+  ctx = multiprocessing.get_context('spawn')
+  queue = ctx.Queue()
+  p = ctx.Process(target=_measure_once, args=(queue, run, args))
+  p.start()
+  p.join()
+  if p.exitcode != 0:
+    log.error(f"Measurement process exited with code {p.exitcode}")
+    return None
+  return queue.get()
+
+def measure(run, args, repeats, drop_caches):
+  # Discarded warm-up run so the first timed run doesn't start at a low P-state
+  if run(*args) is None:
+    return None
+  samples = []
+  for _ in range(repeats):
+    if drop_caches:
+      drop_page_cache()
+    # Each repetition runs from a fresh process so no state carries over between runs
+    sample = run_isolated(run, args)
+    if sample is None:
+      return None
+    samples.append(sample)
+  wall_times = [wall_time for wall_time, _ in samples]
+  cpu_times = [cpu_time for _, cpu_time in samples]
+  return min(wall_times), statistics.median(wall_times), statistics.median(cpu_times)
+
+def write_results(f, base_name, c_stats, rust_stats):
+  c_min, c_median, c_cpu_median = c_stats
+  rust_min, rust_median, rust_cpu_median = rust_stats
   log.info(f"\nResults for {base_name}:")
-  log.info(f"C time: {c_time:.3f}s")
-  log.info(f"Rust time: {rust_time:.3f}s")
-  log.info(f"Rust is {c_time/rust_time:.2f}x faster than C")
-  
-  if not os.path.exists(results_file):
-    with open(results_file, "w") as f:
-      f.write("algorithm,c_time,rust_time,speedup\n")
-      
-  with open(results_file, "a") as f:
-    speedup = c_time/rust_time
-    f.write(f"{base_name},{c_time:.3f},{rust_time:.3f},{speedup:.2f}\n")
-
-def run_benchmark(d, c_file, input_data_file, opt_level, results_file):
+  log.info(f"C time: median {c_median:.3f}s, min {c_min:.3f}s (CPU {c_cpu_median:.3f}s)")
+  log.info(f"Rust time: median {rust_median:.3f}s, min {rust_min:.3f}s (CPU {rust_cpu_median:.3f}s)")
+  log.info(f"Rust is {c_median/rust_median:.2f}x faster than C")
+
+  speedup = c_median/rust_median
+  f.write(f"{base_name},{c_min:.6f},{c_median:.6f},{c_cpu_median:.6f},{rust_min:.6f},{rust_median:.6f},{rust_cpu_median:.6f},{speedup:.2f}\n")
+  f.flush()
+
+RESULTS_HEADER = "algorithm,c_wall_min,c_wall_median,c_cpu_median,rust_wall_min,rust_wall_median,rust_cpu_median,speedup\n"
+
+def build_once(d, base_name, c_file, rust_file, rust_dir, input_size, opt_level):
+  c_out = f"{d}/C/{base_name}.elf"
+  if not compile_c(c_file, c_out, opt_level, input_size):
+    return None
+
+  rust_out = f"{d}/Rust/{base_name}.elf"
+  if not compile_rust(rust_file, rust_dir, rust_out, opt_level):
+    return None
+
+  return c_out, rust_out
+
+def run_benchmark(d, c_file, input_data_file, opt_level, repeats, drop_caches, run_lock, build_lock, results_queue):
   base_name = os.path.splitext(os.path.basename(c_file))[0]
   rust_file = f"{d}/Rust/{base_name}.rs"
   rust_dir = f"{d}/Rust/{base_name}"
 
-  # Check if already evaluated in results.csv
-  if os.path.exists(results_file):
-    with open(results_file, "r") as f:
-      if any(line.startswith(base_name + ",") for line in f):
-        print(f"Skipping {base_name} as it was already evaluated")
-        return
-
   log.info(f"Evaluating {base_name}")
 
   # print(f"Rust file: {rust_file}", os.path.exists(rust_file))
@@ -106,26 +179,26 @@ def run_benchmark(d, c_file, input_data_file, opt_level, results_file):
   input_data = pathlib.Path(input_data_file).read_text()
   input_data_list = input_data.strip().split()
   log.info(f"Input data length: {len(input_data_list)}")
-    
-  c_out = f"{d}/C/{base_name}.elf"
-  c_source = pathlib.Path(c_file).read_text()
-  c_source = c_source.replace("int n = 97;", f"int n = {len(input_data_list)};")
-  if not compile_c_source(c_source, c_out, opt_level):
-    return
 
-  rust_out = f"{d}/Rust/{base_name}.elf"
-  if not compile_rust(rust_file, rust_dir, rust_out, opt_level):
-    return
-    
-  c_time = run_c_benchmark(c_out, input_data_file)
-  if c_time is None:
-    return
-    
-  rust_time = run_rust_benchmark(rust_file, rust_out, rust_dir, input_data_file)
-  if rust_time is None:
+  # Compile once, then time the same binaries `repeats` times
+  with build_lock.shared():
+    outputs = build_once(d, base_name, c_file, rust_file, rust_dir, len(input_data_list), opt_level)
+  if outputs is None:
     return
+  c_out, rust_out = outputs
+  cpus = bench_cpus(d)
     
-  write_results(results_file, base_name, c_time, rust_time)
+  # Compilation runs in parallel, but only one benchmark is timed at a time
+  with timing(d, run_lock, build_lock):
+    c_stats = measure(run_c_benchmark, (c_out, input_data_file, cpus), repeats, drop_caches)
+    if c_stats is None:
+      return
+
+    rust_stats = measure(run_rust_benchmark, (rust_out, input_data_file, cpus), repeats, drop_caches)
+    if rust_stats is None:
+      return
+
+  results_queue.put((base_name, c_stats, rust_stats))
 
 def main():
   parser = argparse.ArgumentParser(description='Run C vs Rust benchmarks')
@@ -133,38 +206,20 @@ def main():
   parser.add_argument('--opt-level', type=int, default=2, help='Optimization level (default: 2)')
   parser.add_argument('--input-data', type=str, default='Benchmarks/Algorithm_Benchmarks/input', help='Input data file path')
   parser.add_argument('-o', '--output', type=str, default='results.csv', help='Output file path')
+  parser.add_argument('--repeats', type=positive_int, default=5, help='Number of timed runs per benchmark (default: 5)')
+  parser.add_argument('--drop-caches', action='store_true', help='Drop the page cache before every timed run (requires root)')
+  parser.add_argument('-j', '--jobs', type=positive_int, default=max(1, os.cpu_count() // 2), help='Number of benchmarks to build in parallel (default: half the CPUs)')
   args = parser.parse_args()
 
-  benchmark_dirs = get_benchmark_dirs()
   input_data_file = pathlib.Path(args.input_data).absolute()
 
-  log.basicConfig(
-      level=log.INFO,
-      format='\033[36m%(asctime)s\033[0m - \033[1;33m%(levelname)s\033[0m - \033[32m%(message)s\033[0m',
-      datefmt='%Y-%m-%d %H:%M:%S'
-  )
-
-  total_benchmarks = 0
-  if args.benchmark:
-    # Run specific benchmark
-    for d in benchmark_dirs:
-      c_file = f"{d}/C/{args.benchmark}.c"
-      if os.path.exists(c_file):
-        run_benchmark(d, c_file, input_data_file, args.opt_level, args.output)
-        total_benchmarks += 1
-        break
-    else:
-      log.error(f"Benchmark {args.benchmark} not found")
-  else:
-    # Run all benchmarks
-    for d in benchmark_dirs:
-      c_files = glob.glob(f"{d}/C/*.c")
-      random.shuffle(c_files)
-      
-      for c_file in c_files:
-        run_benchmark(d, c_file, input_data_file, args.opt_level, args.output)
-        total_benchmarks += 1
-  log.info(f"Total benchmarks: {total_benchmarks}")
+  setup_logging()
+  setup_cpu()
+
+  def make_task(d, c_file, run_lock, build_lock, results_queue):
+    return functools.partial(run_benchmark, d, c_file, input_data_file, args.opt_level, args.repeats, args.drop_caches, run_lock, build_lock, results_queue)
+
+  run_benchmarks(make_task, args.benchmark, args.jobs, args.output, RESULTS_HEADER, write_results)
 
 if __name__ == "__main__":
   main()
\ No newline at end of file
@@ -1,92 +1,135 @@
 import os
 import subprocess
-import time
-import random
-import glob
-import re
+import csv
 import pathlib
 import logging as log
 import argparse
+import multiprocessing
+import functools
+from bench_utils import setup_logging, setup_cpu, bench_command, bench_cpus, timing, compiler_version, cache_key, fetch_cached, store_cached, positive_int, run_benchmarks
 
-def get_benchmark_dirs():
-    dirs = ['Benchmarks/Algorithm_Benchmarks', 'Benchmarks/Performance_Benchmarks']
-    random.shuffle(dirs)
-    return dirs
-
-def compile_with_clang(c_file, out_file, opt_level):
+def compile_with_clang(c_file, out_file, opt_level, input_size):
+    # The input size is passed as a define instead of patching the source
+    cflags = [f'-O{opt_level}', f'-DN_VALUE={input_size}', '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp']
+    key = cache_key(pathlib.Path(c_file).read_bytes(), cflags, compiler_version('clang-18'))
+    if fetch_cached(key, out_file):
+        return True
     try:
-        subprocess.run(['clang-18', f'-O{opt_level}', c_file, '-o', out_file, '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp'], check=True)
+        subprocess.run(['clang-18', c_file, *cflags, '-o', out_file], check=True)
+        store_cached(key, out_file)
         return True
     except subprocess.CalledProcessError:
         log.error(f"Clang compilation failed with -O{opt_level}")
         return False
 
-def compile_with_llvm_opt(c_file, out_file):
+def compile_with_llvm_opt(c_file, out_file, input_size):
+    key = cache_key(pathlib.Path(c_file).read_bytes(), 'llvm-pipeline-O3', f'-DN_VALUE={input_size}', compiler_version('clang-18'), compiler_version('opt-18'))
+    if fetch_cached(key, out_file):
+        return True
     try:
-        ll_file = f"{os.path.splitext(out_file)[0]}.ll"
-        opt_ll_file = f"{os.path.splitext(out_file)[0]}_opt.ll"
-        
-        # Generate LLVM IR
-        subprocess.run(['clang-18', '-O3', '-S', '-emit-llvm', c_file, '-o', ll_file], check=True)
+        # Generate LLVM IR, streamed through pipes instead of intermediate .ll files
+        emit = subprocess.Popen(['clang-18', '-O3', f'-DN_VALUE={input_size}', '-I/usr/include/apr-1.0', '-S', '-emit-llvm', c_file, '-o', '-'], stdout=subprocess.PIPE)
         
         # Optimize with opt
-        subprocess.run(['opt-18', '-O3', ll_file, '-o', opt_ll_file], check=True)
+        optimize = subprocess.Popen(['opt-18', '-O3', '-', '-o', '-'], stdin=emit.stdout, stdout=subprocess.PIPE)
+        emit.stdout.close()
         
         # Compile optimized IR to executable
-        subprocess.run(['clang-18', '-O3', opt_ll_file, '-o', out_file, '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp'], check=True)
+        link = subprocess.Popen(['clang-18', '-O3', '-x', 'ir', '-', '-o', out_file, '-I/usr/include/apr-1.0', '-lapr-1', '-lpthread', '-lgmp'], stdin=optimize.stdout)
+        optimize.stdout.close()
+        
+        for proc in (emit, optimize, link):
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        store_cached(key, out_file)
         
         return True
     except subprocess.CalledProcessError:
         log.error("LLVM optimization pipeline failed")
         return False
 
-def run_benchmark_with_perf(executable, input_data_file):
+PERF_EVENTS = ['duration_time', 'task-clock', 'cycles', 'instructions', 'cache-misses', 'branch-misses']
+PERF_REPEATS = 5
+
+def warm_up(executable, input_data_file, cpus):
+    # Discarded run so the measured runs don't start at a low P-state
+    with open(input_data_file, 'rb') as fin:
+        subprocess.run(bench_command([executable], cpus), stdin=fin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def run_benchmark_with_perf(executable, input_data_file, cpus):
+    warm_up(executable, input_data_file, cpus)
     try:
-        perf_output = subprocess.run(['perf', 'stat', '-e', 'cycles', executable], 
-                                    stdin=open(input_data_file), 
-                                    capture_output=True, 
-                                    errors='ignore',
-                                    text=True, 
-                                    check=True)
+        # perf repeats the run itself and reports the mean with its relative stddev;
+        # -x, makes it print one machine-readable CSV row per event. A shared stdin
+        # would be at EOF after the first repeat, so each repeat goes through a
+        # shell that reopens the input and then execs the benchmark in its place
+        perf = subprocess.Popen(bench_command(['perf', 'stat', '-x,', '-r', str(PERF_REPEATS), '-e', ','.join(PERF_EVENTS),
+                                               '--', 'sh', '-c', 'exec "$0" < "$1"', executable, str(input_data_file)], cpus),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                errors='ignore',
+                                text=True)
         
-        # Extract time and cycles from perf output
-        time_match = re.search(r'(\d+\.\d+) seconds time elapsed', perf_output.stderr)
-        cycles_match = re.search(r'(\d+,\d+|\d+)\s+cycles', perf_output.stderr)
+        # Rows look like value,unit,event,stddev%,... e.g.
+        #   1235012345,ns,duration_time,0.11%,1235012345,100.00,,
+        #   1234.56,msec,task-clock,0.10%,1234560000,100.00,0.999,CPUs utilized
+        #   3412345678,,cycles,0.12%,1234560000,100.00,,
+        counters = {}
+        for row in csv.reader(perf.stderr):
+            if len(row) < 4 or not row[3].endswith('%'):
+                continue
+            event = row[2].split(':')[0]
+            try:
+                counters[event] = float(row[0]), float(row[3].rstrip('%'))
+            except ValueError:
+                # <not counted> / <not supported>
+                continue
+        if perf.wait() != 0:
+            raise subprocess.CalledProcessError(perf.returncode, perf.args)
         
-        if time_match and cycles_match:
-            elapsed_time = float(time_match.group(1))
-            cycles = int(cycles_match.group(1).replace(',', ''))
-            log.info(f"Time elapsed: {elapsed_time:.3f}s, Cycles: {cycles:,}")
-            return elapsed_time, cycles
+        if 'duration_time' in counters and 'task-clock' in counters and 'cycles' in counters:
+            # duration_time is the wall-clock time of each run in ns, task-clock its CPU time in ms
+            duration_ns, duration_stddev = counters['duration_time']
+            elapsed_time = duration_ns / 1e9
+            time_stddev = elapsed_time * duration_stddev / 100
+            task_clock_ms, task_clock_stddev = counters['task-clock']
+            cpu_time = task_clock_ms / 1000
+            cpu_time_stddev = cpu_time * task_clock_stddev / 100
+            cycles, cycles_stddev = int(counters['cycles'][0]), counters['cycles'][1]
+            log.info(f"Time elapsed: {elapsed_time:.3f}s (+- {time_stddev:.3f}s), Task clock: {cpu_time:.3f}s (+- {cpu_time_stddev:.3f}s), Cycles: {cycles:,} (+- {cycles_stddev:.2f}%)")
+            for event in PERF_EVENTS[3:]:
+                if event in counters:
+                    log.info(f"{event}: {int(counters[event][0]):,} (+- {counters[event][1]:.2f}%)")
+            return elapsed_time, time_stddev, cycles, cycles_stddev, cpu_time, cpu_time_stddev
         else:
             log.error("Could not parse perf output")
-            return None, None
+            return None
     except subprocess.CalledProcessError:
         log.error("Benchmark execution failed")
-        return None, None
+        return None
 
-def write_results(results_file, base_name, o2_time, o2_cycles, o3_time, o3_cycles, llvm_time, llvm_cycles):
+def write_results(f, base_name, o2_stats, o3_stats, llvm_stats):
+    o2_time, o2_time_stddev, o2_cycles, o2_cycles_stddev, o2_task_clock, o2_task_clock_stddev = o2_stats
+    o3_time, o3_time_stddev, o3_cycles, o3_cycles_stddev, o3_task_clock, o3_task_clock_stddev = o3_stats
+    llvm_time, llvm_time_stddev, llvm_cycles, llvm_cycles_stddev, llvm_task_clock, llvm_task_clock_stddev = llvm_stats
     log.info(f"\nResults for {base_name}:")
-    log.info(f"Clang -O2 time: {o2_time:.3f}s, cycles: {o2_cycles:,}")
-    log.info(f"Clang -O3 time: {o3_time:.3f}s, cycles: {o3_cycles:,}")
-    log.info(f"LLVM pipeline time: {llvm_time:.3f}s, cycles: {llvm_cycles:,}")
+    log.info(f"Clang -O2 time: {o2_time:.3f}s (+- {o2_time_stddev:.3f}s), task clock: {o2_task_clock:.3f}s (+- {o2_task_clock_stddev:.3f}s), cycles: {o2_cycles:,} (+- {o2_cycles_stddev:.2f}%)")
+    log.info(f"Clang -O3 time: {o3_time:.3f}s (+- {o3_time_stddev:.3f}s), task clock: {o3_task_clock:.3f}s (+- {o3_task_clock_stddev:.3f}s), cycles: {o3_cycles:,} (+- {o3_cycles_stddev:.2f}%)")
+    log.info(f"LLVM pipeline time: {llvm_time:.3f}s (+- {llvm_time_stddev:.3f}s), task clock: {llvm_task_clock:.3f}s (+- {llvm_task_clock_stddev:.3f}s), cycles: {llvm_cycles:,} (+- {llvm_cycles_stddev:.2f}%)")
     
-    if not os.path.exists(results_file):
-        with open(results_file, "w") as f:
-            f.write("algorithm,clang_o2_time,clang_o2_cycles,clang_o3_time,clang_o3_cycles,llvm_pipeline_time,llvm_pipeline_cycles\n")
-            
-    with open(results_file, "a") as f:
-        f.write(f"{base_name},{o2_time:.3f},{o2_cycles},{o3_time:.3f},{o3_cycles},{llvm_time:.3f},{llvm_cycles}\n")
+    f.write(f"{base_name},{o2_time:.6f},{o2_time_stddev:.6f},{o2_cycles},{o2_cycles_stddev:.2f},{o2_task_clock:.6f},{o2_task_clock_stddev:.6f},"
+            f"{o3_time:.6f},{o3_time_stddev:.6f},{o3_cycles},{o3_cycles_stddev:.2f},{o3_task_clock:.6f},{o3_task_clock_stddev:.6f},"
+            f"{llvm_time:.6f},{llvm_time_stddev:.6f},{llvm_cycles},{llvm_cycles_stddev:.2f},{llvm_task_clock:.6f},{llvm_task_clock_stddev:.6f}\n")
+    f.flush()
 
-def run_benchmark(d, c_file, input_data_file, results_file):
-    base_name = os.path.splitext(os.path.basename(c_file))[0]
+RESULTS_HEADER = ("algorithm,clang_o2_time,clang_o2_time_stddev,clang_o2_cycles,clang_o2_cycles_stddev_pct,clang_o2_task_clock,clang_o2_task_clock_stddev,"
+                  "clang_o3_time,clang_o3_time_stddev,clang_o3_cycles,clang_o3_cycles_stddev_pct,clang_o3_task_clock,clang_o3_task_clock_stddev,"
+                  "llvm_pipeline_time,llvm_pipeline_time_stddev,llvm_pipeline_cycles,llvm_pipeline_cycles_stddev_pct,llvm_pipeline_task_clock,llvm_pipeline_task_clock_stddev\n")
 
-    # Check if already evaluated in results.csv
-    if os.path.exists(results_file):
-        with open(results_file, "r") as f:
-            if any(line.startswith(base_name + ",") for line in f):
-                print(f"Skipping {base_name} as it was already evaluated")
-                return
+def run_benchmark(d, c_file, input_data_file, run_lock, build_lock, results_queue):
+    base_name = os.path.splitext(os.path.basename(c_file))[0]
+    cpus = bench_cpus(d)
 
     log.info(f"Evaluating {base_name}")
     
@@ -94,96 +137,64 @@ def run_benchmark(d, c_file, input_data_file, results_file):
     input_data_list = input_data.strip().split()
     log.info(f"Input data length: {len(input_data_list)}")
     
-    # Prepare C source with correct input size
-    c_source = pathlib.Path(c_file).read_text()
-    c_source = c_source.replace("int n = 97;", f"int n = {len(input_data_list)};")
-    
-    # Write modified source to a temporary file
-    temp_c_file = f"{d}/C/{base_name}_temp.c"
-    with open(temp_c_file, "w") as f:
-        f.write(c_source)
-    
     # Compile with clang -O2
     o2_out = f"{d}/C/{base_name}_O2.elf"
-    if not compile_with_clang(temp_c_file, o2_out, 2):
-        os.remove(temp_c_file)
+    with build_lock.shared():
+        built = compile_with_clang(c_file, o2_out, 2, len(input_data_list))
+    if not built:
         return
     
     # Run with perf stat
-    o2_time, o2_cycles = run_benchmark_with_perf(o2_out, input_data_file)
-    if o2_time is None:
-        os.remove(temp_c_file)
+    with timing(d, run_lock, build_lock):
+        o2_stats = run_benchmark_with_perf(o2_out, input_data_file, cpus)
+    if o2_stats is None:
         return
     
     # Compile with clang -O3
     o3_out = f"{d}/C/{base_name}_O3.elf"
-    if not compile_with_clang(temp_c_file, o3_out, 3):
-        os.remove(temp_c_file)
+    with build_lock.shared():
+        built = compile_with_clang(c_file, o3_out, 3, len(input_data_list))
+    if not built:
         return
     
     # Run with perf stat
-    o3_time, o3_cycles = run_benchmark_with_perf(o3_out, input_data_file)
-    if o3_time is None:
-        os.remove(temp_c_file)
+    with timing(d, run_lock, build_lock):
+        o3_stats = run_benchmark_with_perf(o3_out, input_data_file, cpus)
+    if o3_stats is None:
         return
     
     # Compile with LLVM optimization pipeline
     llvm_out = f"{d}/C/{base_name}_LLVM.elf"
-    if not compile_with_llvm_opt(temp_c_file, llvm_out):
-        os.remove(temp_c_file)
+    with build_lock.shared():
+        built = compile_with_llvm_opt(c_file, llvm_out, len(input_data_list))
+    if not built:
         return
     
     # Run with perf stat
-    llvm_time, llvm_cycles = run_benchmark_with_perf(llvm_out, input_data_file)
-    if llvm_time is None:
-        os.remove(temp_c_file)
+    with timing(d, run_lock, build_lock):
+        llvm_stats = run_benchmark_with_perf(llvm_out, input_data_file, cpus)
+    if llvm_stats is None:
         return
     
-    # Clean up temporary file
-    os.remove(temp_c_file)
-    
-    # Write results
-    write_results(results_file, base_name, o2_time, o2_cycles, o3_time, o3_cycles, llvm_time, llvm_cycles)
+    results_queue.put((base_name, o2_stats, o3_stats, llvm_stats))
 
 def main():
     parser = argparse.ArgumentParser(description='Run C benchmarks with different optimization levels')
     parser.add_argument('--benchmark', type=str, help='Specific benchmark to run (without extension)')
     parser.add_argument('--input-data', type=str, default='Benchmarks/Algorithm_Benchmarks/input', help='Input data file path')
     parser.add_argument('-o', '--output', type=str, default='llvm-pipeline-results.csv', help='Output file path')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=max(1, os.cpu_count() // 2), help='Number of benchmarks to build in parallel (default: half the CPUs)')
     args = parser.parse_args()
 
-    benchmark_dirs = get_benchmark_dirs()
     input_data_file = pathlib.Path(args.input_data).absolute()
 
-    log.basicConfig(
-        level=log.INFO,
-        format='\033[36m%(asctime)s\033[0m - \033[1;33m%(levelname)s\033[0m - \033[32m%(message)s\033[0m',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    setup_logging()
+    setup_cpu()
 
-    total_benchmarks = 0
-    if args.benchmark:
-        # Run specific benchmark
-        for d in benchmark_dirs:
-            c_file = f"{d}/C/{args.benchmark}.c"
-            if os.path.exists(c_file):
-                run_benchmark(d, c_file, input_data_file, args.output)
-                total_benchmarks += 1
-                break
-        else:
-            log.error(f"Benchmark {args.benchmark} not found")
-    else:
-        # Run all benchmarks
-        for d in benchmark_dirs:
-            c_files = glob.glob(f"{d}/C/*.c")
-            random.shuffle(c_files)
-            
-            for c_file in c_files:
-              if os.path.exists(c_file):
-                run_benchmark(d, c_file, input_data_file, args.output)
-                total_benchmarks += 1
-    
-    log.info(f"Total benchmarks: {total_benchmarks}")
+    def make_task(d, c_file, run_lock, build_lock, results_queue):
+        return functools.partial(run_benchmark, d, c_file, input_data_file, run_lock, build_lock, results_queue)
+
+    run_benchmarks(make_task, args.benchmark, args.jobs, args.output, RESULTS_HEADER, write_results)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file